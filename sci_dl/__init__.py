@@ -1,2 +1,4 @@
 # -*- coding: utf-8 -*-
-from .sci_dl import SciDlError, Proxy, Dl, Sci, dl_by_doi
+from .sci_dl import (
+    SciDlError, Proxy, Dl, AsyncDl, Sci, dl_by_doi, dl_by_doi_async, dl_many
+)
@@ -2,28 +2,28 @@
 """
 sci-dl command line
 """
+import os
 import json
+import time
+import asyncio
 import codecs
 import gettext
 import logging
+import functools
 from os import makedirs
-from pkg_resources import resource_filename
+from logging.handlers import RotatingFileHandler
 from os.path import join, exists, dirname, expanduser
 
 import click
-import validators
-from rich.console import Console
 from appdirs import user_config_dir, user_log_dir
-from rich.prompt import Prompt, IntPrompt, Confirm
-from rich.progress import (
-    BarColumn, DownloadColumn, Progress,
-    TextColumn, TimeRemainingColumn, TransferSpeedColumn,
-)
 
-from .sci_dl import SciDlError, Proxy, Dl, Sci, DEFAULT_ENCODING
+from .sci_dl import (
+    SciDlError, Proxy, Dl, AsyncDl, Sci, dl_by_doi_async,
+    DEFAULT_ENCODING, DEFAULT_CONCURRENCY, MATCHMAKER_CHUNK_SIZE,
+)
 
 # translation configuration
-LOCALEDIR = resource_filename('sci_dl', 'locale')
+LOCALEDIR = join(dirname(__file__), 'locale')
 try:
     _ = gettext.translation('sci-dl', LOCALEDIR).gettext
 except FileNotFoundError:
@@ -48,7 +48,14 @@ DEFAULT_PROXY_USER = ''
 DEFAULT_PROXY_PASSWORD = ''
 DEFAULT_PROXY_HOST = '127.0.0.1'
 DEFAULT_PROXY_PORT = 1080
-CHUNK_SIZE = 128
+CHUNK_SIZE = 64 * 1024
+# file buffer holds many chunks, so a PDF is written in few syscalls
+WRITE_BUFFER_SIZE = 1024 * 1024
+PROGRESS_UPDATE_SIZE = 256 * 1024
+PROGRESS_UPDATE_INTERVAL = 0.05
+MAX_CONCURRENCY = 64
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
 UNKNOWN_ERROR_MSG = _(
     'Unknown error occurred, please refer to log file to get more detail.'
 )
@@ -81,17 +88,208 @@ class Config(dict):
             return json.dump(self, fp, indent=4)
 
 
-progress = Progress(
-    TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
-    BarColumn(bar_width=None),
-    "[progress.percentage]{task.percentage:>3.1f}%",
-    "•",
-    DownloadColumn(),
-    "•",
-    TransferSpeedColumn(),
-    "•",
-    TimeRemainingColumn(),
-)
+class ProgressUpdater(object):
+    """
+    coalesce progress updates, update at most every
+    PROGRESS_UPDATE_SIZE bytes or PROGRESS_UPDATE_INTERVAL seconds
+    """
+
+    def __init__(self, progress, task_id):
+        self.progress = progress
+        self.task_id = task_id
+        self.pending = 0
+        self.last_update = time.monotonic()
+
+    def advance(self, size):
+        self.pending += size
+        now = time.monotonic()
+        if (
+            self.pending >= PROGRESS_UPDATE_SIZE
+            or now - self.last_update >= PROGRESS_UPDATE_INTERVAL
+        ):
+            self.flush()
+            self.last_update = now
+
+    def flush(self):
+        if self.pending:
+            self.progress.update(self.task_id, advance=self.pending)
+            self.pending = 0
+
+
+@functools.lru_cache(maxsize=None)
+def get_progress():
+    """
+    only dl command needs it, build it the first time it's used
+    """
+    from rich.progress import (
+        BarColumn, DownloadColumn, Progress,
+        TextColumn, TimeRemainingColumn, TransferSpeedColumn,
+    )
+
+    return Progress(
+        TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
+        BarColumn(bar_width=None),
+        "[progress.percentage]{task.percentage:>3.1f}%",
+        "•",
+        DownloadColumn(),
+        "•",
+        TransferSpeedColumn(),
+        "•",
+        TimeRemainingColumn(),
+    )
+
+
+def setup_logging(config):
+    """
+    log file is opened on the first record, a successful run doesn't touch it
+    """
+    handler = RotatingFileHandler(
+        config.get_config('log_file'),
+        maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+        encoding=DEFAULT_ENCODING, delay=True,
+    )
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    if config.get_config('debug_mode'):
+        root.setLevel(logging.DEBUG)
+
+
+def read_dois(file):
+    """
+    one DOI per line, blank lines and repeated DOIs are ignored
+    """
+    with codecs.open(file, encoding=DEFAULT_ENCODING) as fp:
+        return list(dict.fromkeys(line.strip() for line in fp if line.strip()))
+
+
+def preallocate(fp, size):
+    """
+    reserve disk space for the whole file, less fragmentation
+    """
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fp.fileno(), 0, size)
+    except OSError:
+        # not supported by some file systems
+        pass
+
+
+def open_pdf(file, size, buffering=-1):
+    """
+    open PDF file for writing, disk space is reserved for size bytes
+    """
+    fp = open(file, 'wb', buffering=buffering)
+    preallocate(fp, size)
+    return fp
+
+
+def close_pdf(fp):
+    """
+    drop space reserved for bytes that never arrived, then close
+    """
+    try:
+        fp.truncate()
+    finally:
+        fp.close()
+
+
+def write_pdf(file, chunks, size, updater):
+    """
+    write chunks into a preallocated file, the file is truncated to
+    what was written even if the download fails halfway
+    """
+    fp = open_pdf(file, size, WRITE_BUFFER_SIZE)
+    try:
+        for chunk in chunks:
+            fp.write(chunk)
+            updater.advance(len(chunk))
+    finally:
+        close_pdf(fp)
+    updater.flush()
+
+
+async def write_pdf_async(file, chunks, size, updater):
+    """
+    write_pdf for an async iterator of chunks
+    """
+    loop = asyncio.get_running_loop()
+    # every file system call runs in the executor, so a slow disk doesn't
+    # block other downloads, eg, posix_fallocate writes the whole file
+    # where the file system can't reserve space natively, the default
+    # buffer is kept, so 64 KiB chunks are written in the executor too
+    fp = await loop.run_in_executor(None, open_pdf, file, size)
+    try:
+        async for chunk in chunks:
+            await loop.run_in_executor(None, fp.write, chunk)
+            updater.advance(len(chunk))
+    finally:
+        await loop.run_in_executor(None, close_pdf, fp)
+    updater.flush()
+
+
+def get_pdf_filename(doi):
+    return '%s.pdf' % doi.replace(r'/', '_')
+
+
+async def dl_pdf_async(doi, dl, sh, semaphore, outdir, console):
+    async with semaphore:
+        pdf_response = await dl_by_doi_async(doi, dl, sh)
+        async with pdf_response:
+            if pdf_response.headers.get('Content-Type') != 'application/pdf':
+                raise SciDlError(
+                    _('Failed to Download PDF url %s of DOI %s')
+                    % (pdf_response.url, doi)
+                )
+            fn = get_pdf_filename(doi)
+            file = join(outdir, fn)
+            progress = get_progress()
+            task_id = progress.add_task(
+                'Download', filename=fn, total=pdf_response.content_length
+            )
+            updater = ProgressUpdater(progress, task_id)
+            await write_pdf_async(
+                file, pdf_response.content.iter_chunked(CHUNK_SIZE),
+                pdf_response.content_length, updater
+            )
+    console.log(_(
+        'Congratulations, PDF was saved to %s successfully.'
+    ) % file)
+
+
+async def dl_pdfs_async(dois, dl, sh, concurrency, outdir, console):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with dl:
+        return await asyncio.gather(
+            *[
+                dl_pdf_async(doi, dl, sh, semaphore, outdir, console)
+                for doi in dois
+            ],
+            return_exceptions=True
+        )
+
+
+def dl_bulk(dois, dl, sh, concurrency, outdir, console):
+    """
+    download PDFs of DOIs concurrently, a failed DOI doesn't stop others
+    """
+    with get_progress():
+        results = asyncio.run(
+            dl_pdfs_async(dois, dl, sh, concurrency, outdir, console)
+        )
+    failures = 0
+    for doi, result in zip(dois, results):
+        if not isinstance(result, Exception):
+            continue
+        failures += 1
+        logger.error('failed to download %s', doi, exc_info=result)
+        msg = str(result) if isinstance(result, SciDlError) else UNKNOWN_ERROR_MSG
+        console.log(_('Failed to download DOI %s: %s') % (doi, msg))
+    if failures:
+        raise SciDlError(
+            _('%s of %s DOIs failed to download') % (failures, len(dois))
+        )
 
 
 @click.group()
@@ -106,6 +304,10 @@ def sci_dl_init_config():
     """
     initialize sci-dl configuration
     """
+    import validators
+    from rich.console import Console
+    from rich.prompt import Prompt, IntPrompt, Confirm
+
     try:
         console = Console()
         # base_url
@@ -240,24 +442,29 @@ def sci_dl_init_config():
 
 @sci_dl.command('dl')
 @click.option(
-    '-d', '--doi', required=True,
+    '-d', '--doi',
     help='DOI, eg, 10.1002/9781118445112.stat06003'
 )
-def sci_dl_dl(doi):
+@click.option(
+    '-f', '--doi-file', type=click.Path(exists=True, dir_okay=False),
+    help='file of DOIs, one DOI per line'
+)
+@click.option(
+    '-c', '--concurrency', default=DEFAULT_CONCURRENCY, show_default=True,
+    type=click.IntRange(1, MAX_CONCURRENCY),
+    help='number of DOIs downloading at the same time, used with --doi-file'
+)
+def sci_dl_dl(doi, doi_file, concurrency):
     """
     download SciHub PDF using DOI
     """
+    from rich.console import Console
+
     try:
+        if not doi and not doi_file:
+            raise SciDlError(_('one of --doi and --doi-file is required'))
         config = Config.load(CONFIG_FILE)
-        if config.get_config('debug_mode'):
-            logging.basicConfig(
-                level=logging.DEBUG,
-                filename=config.get_config('log_file')
-            )
-        else:
-            logging.basicConfig(
-                filename=config.get_config('log_file')
-            )
+        setup_logging(config)
         console = Console()
         sh = Sci(config.get_config('base_url'))
         if config.get_config('use_proxy'):
@@ -270,38 +477,52 @@ def sci_dl_dl(doi):
             )
         else:
             proxy = None
-        dl = Dl(config.get_config('retries'), proxy=proxy)
+        if doi_file:
+            # --doi may be in the file too, download it only once
+            dois = list(dict.fromkeys(
+                ([doi] if doi else []) + read_dois(doi_file)
+            ))
+            console.log(_('Received %s DOIs') % len(dois))
+            dl = AsyncDl(config.get_config('retries'), proxy=proxy)
+            dl_bulk(
+                dois, dl, sh, concurrency, config.get_config('outdir'), console
+            )
+            return
         console.log(_('Received DOI [bold][green]%s[/green][/bold]') % doi)
+        with Dl(config.get_config('retries'), proxy=proxy) as dl:
+            # get matchmaker url and download the page
+            matchmaker_url = sh.get_matchmaker_url_for_doi(doi)
+            matchmaker_response = dl.dl(matchmaker_url)
 
-        # get matchmaker url and download the page
-        matchmaker_url = sh.get_matchmaker_url_for_doi(doi)
-        matchmaker_response = dl.dl(matchmaker_url)
-
-        # parse PDF url
-        pdf_url = sh.parse_pdf_url(matchmaker_response.text)
-        if pdf_url is None:
-            msg = _('Failed to parse PDF url of DOI %s') % doi
-            logger.error(msg)
-            raise SciDlError(msg)
-        console.log(_('Find PDF url %s') % pdf_url)
-
-        # download PDF
-        pdf_response = dl.dl(pdf_url)
-        content_type = pdf_response.headers['Content-Type']
-        if content_type != 'application/pdf':
-            msg = _('Failed to Download PDF url %s of DOI %s') % (pdf_url, doi)
-            logger.error(msg)
-            raise SciDlError(msg)
-        content_length = int(pdf_response.headers['Content-Length'])
-        fn = '%s.pdf' % doi.replace(r'/', '_')
-        file = join(config.get_config('outdir'), fn)
-        task_id = progress.add_task('Download', filename=fn)
-        progress.update(task_id, total=content_length)
-        with progress, open(file, 'wb') as fp:
-            for chunk in pdf_response.iter_content(CHUNK_SIZE):
-                fp.write(chunk)
-                size = len(chunk)
-                progress.update(task_id, advance=size)
+            # parse PDF url, stop reading page once it's found
+            chunks = matchmaker_response.iter_content(MATCHMAKER_CHUNK_SIZE)
+            pdf_url = sh.find_pdf_url(chunks)
+            dl.release(matchmaker_response, chunks)
+            if pdf_url is None:
+                msg = _('Failed to parse PDF url of DOI %s') % doi
+                logger.error(msg)
+                raise SciDlError(msg)
+            console.log(_('Find PDF url %s') % pdf_url)
+
+            # download PDF
+            pdf_response = dl.dl(pdf_url)
+            content_type = pdf_response.headers['Content-Type']
+            if content_type != 'application/pdf':
+                msg = _('Failed to Download PDF url %s of DOI %s') % (pdf_url, doi)
+                logger.error(msg)
+                raise SciDlError(msg)
+            content_length = int(pdf_response.headers['Content-Length'])
+            fn = get_pdf_filename(doi)
+            file = join(config.get_config('outdir'), fn)
+            progress = get_progress()
+            task_id = progress.add_task('Download', filename=fn)
+            progress.update(task_id, total=content_length)
+            updater = ProgressUpdater(progress, task_id)
+            with progress:
+                write_pdf(
+                    file, pdf_response.iter_content(CHUNK_SIZE),
+                    content_length, updater
+                )
         console.log(_(
             'Congratulations, PDF was saved to %s successfully.'
         ) % file)
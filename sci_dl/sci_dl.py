@@ -2,12 +2,18 @@
 """
 sci-dl helps you download SciHub PDF faster
 """
+import re
+import time
+import random
+import asyncio
 import logging
+from html import unescape
+from concurrent.futures import ThreadPoolExecutor
 from gettext import gettext as _
-from urllib.parse import urljoin, quote
+from urllib.parse import quote
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger('sci-dl')
 DEFAULT_ENCODING = 'UTF-8'
@@ -19,6 +25,36 @@ HEADERS = {
     )
 }
 DEFAULT_CONFIG = {'base_url': 'https://sci-hub.se', 'retries': 5, 'use_proxy': False}
+DEFAULT_CONCURRENCY = 8
+LIMIT_PER_HOST = 64
+# proxy protocols aiohttp_socks can connect through, https is not one
+ASYNC_PROXY_PROTOCOLS = ('socks4', 'socks5', 'http')
+KEEPALIVE_TIMEOUT = 30
+# no total timeout, a large PDF may take long, but a stalled socket fails
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+MATCHMAKER_CHUNK_SIZE = 8 * 1024
+MAX_DRAIN_SIZE = 64 * 1024
+# longest tag searched across a chunk boundary while streaming
+MAX_TAG_SIZE = 4 * 1024
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+TOO_MANY_REQUESTS = 429
+PDF_CONTENT_TYPE = 'application/pdf'
+DOI_PATTERN = re.compile(r'10\.\d{4,9}/\S+')
+# onclick of the "save" button in matchmaker page
+PDF_URL_PATTERN = re.compile(
+    rb'<button[^>]*\sonclick\s*=\s*"([^"]*)"[^>]*>[^<]*save', re.I
+)
+# PDF viewer, eg, <embed type="application/pdf" src="/xxx.pdf" id="pdf">
+PDF_FRAME_PATTERN = re.compile(
+    rb'<(?:iframe|embed)\b[^>]*\sid\s*=\s*["\']pdf["\'][^>]*>', re.I
+)
+SRC_PATTERN = re.compile(rb'\ssrc\s*=\s*["\']([^"\']+)["\']', re.I)
+LOCATION_HREF_PATTERN = re.compile(r"""location\.href\s*=\s*['"]([^'"]+)['"]""")
+SCHEME_PATTERN = re.compile(r'^https?:', re.I)
 
 
 class SciDlError(Exception):
@@ -26,10 +62,35 @@ class SciDlError(Exception):
 
 
 def is_valid_doi(doi):
-    return '/' in doi
+    return bool(DOI_PATTERN.fullmatch(doi))
+
+
+def is_retryable_status(status):
+    return status == TOO_MANY_REQUESTS or status >= 500
+
+
+def get_backoff_delay(retry, base_delay, max_delay):
+    """
+    truncated exponential backoff with full jitter
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** retry)))
+
+
+def get_retry_after(headers):
+    """
+    seconds in Retry-After header, 0 if missing or in HTTP-date format
+    """
+    try:
+        return int(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 0
 
 
 class Proxy(object):
+    __slots__ = (
+        'protocol', 'user', 'password', 'host', 'port', '_url', '_requests'
+    )
+
     def __init__(
         self, protocol='socks5', user='', password='', host='127.0.0.1', port=1080
     ):
@@ -38,13 +99,26 @@ class Proxy(object):
         self.password = password
         self.host = host
         self.port = port
+        # used by every request, build once
+        self._cache_url()
 
-    def to_url(self):
+    def __setattr__(self, name, value):
+        super(Proxy, self).__setattr__(name, value)
+        # a field changed after __init__, the cached url is stale
+        if not name.startswith('_') and hasattr(self, '_url'):
+            self._cache_url()
+
+    def _cache_url(self):
+        self._url = self._build_url()
+        self._requests = {'http': self._url, 'https': self._url}
+
+    def _build_url(self):
         if self.user and self.password:
             return '{protocol}://{user}:{password}@{host}:{port}'.format(
                 protocol=self.protocol,
-                user=self.user,
-                password=quote(self.password),
+                # '/', ':' and '@' must not leak into the netloc
+                user=quote(self.user, safe=''),
+                password=quote(self.password, safe=''),
                 host=self.host,
                 port=self.port,
             )
@@ -52,61 +126,295 @@ class Proxy(object):
             protocol=self.protocol, host=self.host, port=self.port
         )
 
+    def to_url(self):
+        return self._url
+
     def __repr__(self):
         return self.to_url()
 
     def to_requests(self):
-        return {'http': self.to_url(), 'https': self.to_url()}
+        # requests may add environment proxies into it, hand out a copy
+        return self._requests.copy()
 
 
 class Dl(object):
-    def __init__(self, retries=3, proxy=None):
+    def __init__(
+        self, retries=3, proxy=None,
+        base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+        pool_maxsize=POOL_MAXSIZE,
+    ):
         self.retries = retries
         self.proxy = proxy
+        self.proxies = proxy.to_requests() if proxy else None
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # keep-alive connections are reused between matchmaker and PDF
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(HEADERS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.session.close()
 
     def _dl(self, url):
-        proxies = self.proxy.to_requests() if self.proxy else None
-        return requests.get(url, headers=HEADERS, stream=True, proxies=proxies)
+        return self.session.get(url, stream=True, proxies=self.proxies)
+
+    @staticmethod
+    def release(response, chunks):
+        """
+        close a partially read response, the rest of body is drained
+        if it's short, so that the connection can be reused
+        """
+        drained = 0
+        for chunk in chunks:
+            drained += len(chunk)
+            if drained > MAX_DRAIN_SIZE:
+                break
+        response.close()
+
+    def get_delay(self, retry, retry_after=0):
+        delay = get_backoff_delay(retry, self.base_delay, self.max_delay)
+        return max(delay, min(retry_after, self.max_delay))
 
     def dl(self, url):
         for i in range(self.retries):
+            retry_after = 0
             try:
-                return self._dl(url)
-            except Exception as e:
+                response = self._dl(url)
+            except requests.exceptions.RequestException as e:
                 logger.exception(e)
+            else:
+                if response.status_code < 400:
+                    return response
+                logger.warning('%s responded %s', url, response.status_code)
+                retry_after = get_retry_after(response.headers)
+                response.close()
+                # 4xx other than 429 won't get better by retrying
+                if not is_retryable_status(response.status_code):
+                    break
+            if i + 1 < self.retries:
                 logger.warning(_('retrying...'))
+                time.sleep(self.get_delay(i, retry_after))
+        raise SciDlError(_('download %s failure') % url)
+
+
+class AsyncDl(object):
+    """
+    asyncio version of Dl, all downloads share one aiohttp session,
+    use it as an async context manager:
+
+        async with AsyncDl(retries, proxy) as dl:
+            response = await dl.dl(url)
+    """
+
+    def __init__(
+        self, retries=3, proxy=None,
+        base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+    ):
+        self.retries = retries
+        self.proxy = proxy
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.session = None
+
+    async def __aenter__(self):
+        try:
+            import aiohttp
+            from aiohttp_socks import ProxyConnector
+        except ImportError:
+            raise SciDlError(
+                _('aiohttp and aiohttp_socks are required, '
+                  'please install them by "pip install \'sci-dl[async]\'"')
+            )
+        if self.proxy and self.proxy.protocol not in ASYNC_PROXY_PROTOCOLS:
+            raise SciDlError(
+                _('%s proxy is not supported by concurrent download, '
+                  'please use a socks5 or http proxy') % self.proxy.protocol
+            )
+        kwargs = {
+            'limit_per_host': LIMIT_PER_HOST,
+            'keepalive_timeout': KEEPALIVE_TIMEOUT,
+        }
+        if self.proxy:
+            connector = ProxyConnector.from_url(self.proxy.to_url(), **kwargs)
+        else:
+            connector = aiohttp.TCPConnector(**kwargs)
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=HEADERS, timeout=timeout
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        self.session = None
+
+    def get_delay(self, retry, retry_after=0):
+        delay = get_backoff_delay(retry, self.base_delay, self.max_delay)
+        return max(delay, min(retry_after, self.max_delay))
+
+    async def dl(self, url):
+        """
+        the response body is not read, release it after use
+        """
+        import aiohttp
+        from aiohttp_socks import (
+            ProxyError, ProxyConnectionError, ProxyTimeoutError
+        )
+
+        for i in range(self.retries):
+            retry_after = 0
+            try:
+                response = await self.session.get(url)
+            # aiohttp_socks errors are not ClientError
+            except (
+                aiohttp.ClientError, asyncio.TimeoutError,
+                ProxyError, ProxyConnectionError, ProxyTimeoutError,
+            ) as e:
+                logger.exception(e)
+            else:
+                if response.status < 400:
+                    return response
+                logger.warning('%s responded %s', url, response.status)
+                retry_after = get_retry_after(response.headers)
+                response.release()
+                if not is_retryable_status(response.status):
+                    break
+            if i + 1 < self.retries:
+                logger.warning(_('retrying...'))
+                await asyncio.sleep(self.get_delay(i, retry_after))
         raise SciDlError(_('download %s failure') % url)
 
 
 class Sci(object):
+    __slots__ = ('base_url', '_protocol', '_base_url', '_matchmaker_prefix')
+
     def __init__(self, base_url):
         self.base_url = base_url
+        self._protocol = 'https' if base_url.startswith('https') else 'http'
+        self._base_url = base_url.rstrip('/')
+        self._matchmaker_prefix = self._base_url + '/'
 
     def get_protocol(self):
-        if self.base_url.startswith('https'):
-            return 'https'
-        return 'http'
+        return self._protocol
 
     def get_matchmaker_url_for_doi(self, doi):
         if not is_valid_doi(doi):
-            raise SciDlError(_('invalid DOI %s') % doi)
-        return urljoin(self.base_url, doi)
+            raise SciDlError(
+                _('invalid DOI %s, DOI looks like 10.1002/xxx') % doi
+            )
+        return self._matchmaker_prefix + doi
 
     def clean_pdf_url(self, pdf_url):
-        # 找到/downloads位置
-        index = pdf_url.find('/downloads')
-        return pdf_url[index:-1]
+        # location.href='/downloads/xxx.pdf' -> /downloads/xxx.pdf
+        match = LOCATION_HREF_PATTERN.search(pdf_url)
+        return match.group(1) if match else pdf_url
+
+    def to_absolute_url(self, pdf_url):
+        pdf_url = self.clean_pdf_url(pdf_url)
+        # some PDFs are served by other hosts, eg, //zero.sci-hub.se/xxx.pdf
+        if pdf_url.startswith('//'):
+            return '%s:%s' % (self._protocol, pdf_url)
+        if SCHEME_PATTERN.match(pdf_url):
+            return pdf_url
+        return self._base_url + pdf_url
+
+    def _match_to_pdf_url(self, match):
+        pdf_url = unescape(match.group(1).decode(DEFAULT_ENCODING, 'replace'))
+        return self.to_absolute_url(pdf_url)
+
+    def _search_pdf_url(self, content, pos=0):
+        match = PDF_URL_PATTERN.search(content, pos)
+        if match:
+            return self._match_to_pdf_url(match)
+        # no save button, use PDF viewer's url without #view=FitH etc.
+        match = PDF_FRAME_PATTERN.search(content, pos)
+        src = match and SRC_PATTERN.search(match.group(0))
+        if src:
+            return self._match_to_pdf_url(src).split('#', 1)[0]
+        return None
 
     def parse_pdf_url(self, content):
-        soup = BeautifulSoup(content, features='html.parser')
+        if isinstance(content, str):
+            content = content.encode(DEFAULT_ENCODING)
+        pdf_url = self._search_pdf_url(content)
+        if pdf_url:
+            return pdf_url
+        # unusual markup, let BeautifulSoup have a try
+        pdf_url = self._soup_pdf_url(content)
+        return self.to_absolute_url(pdf_url) if pdf_url else None
+
+    def find_pdf_url(self, chunks):
+        """
+        parse PDF url while matchmaker page is downloading,
+        chunks are not consumed any more once the url is found
+        """
+        content = bytearray()
+        for chunk in chunks:
+            # search new bytes only, plus a tag cut by the previous chunk
+            pos = max(0, len(content) - MAX_TAG_SIZE)
+            content.extend(chunk)
+            pdf_url = self._search_pdf_url(content, pos)
+            if pdf_url:
+                return pdf_url
+        return self.parse_pdf_url(bytes(content))
+
+    @staticmethod
+    def _soup_pdf_url(content):
+        from bs4 import BeautifulSoup, SoupStrainer
+
+        # only build the tree of buttons, not the whole page
+        soup = BeautifulSoup(
+            content, features='html.parser',
+            parse_only=SoupStrainer('div', id='buttons'),
+        )
         buttons = soup.find('div', id='buttons')
         if not buttons:
             return None
         pdf_url = None
         for button in buttons.find_all('button'):
-            if 'save' in button.string:
+            if button.string and 'save' in button.string:
                 pdf_url = button.attrs['onclick']
-        return (self.base_url + self.clean_pdf_url(pdf_url)) if pdf_url else None
+        return pdf_url
+
+
+def _parse_config(config):
+    """
+    create Sci, Proxy and number of retries from configuration,
+    see dl_by_doi for configuration keys
+    """
+
+    def get(key):
+        if key not in config:
+            raise SciDlError(_("malformed configuration, can't find %s") % key)
+        return config[key]
+
+    if config is None:
+        config = DEFAULT_CONFIG.copy()
+
+    sci = Sci(get('base_url'))
+    proxy = None
+    if get('use_proxy'):
+        proxy = Proxy(
+            protocol=get('proxy_protocol'),
+            user=get('proxy_user'),
+            password=get('proxy_password'),
+            host=get('proxy_host'),
+            port=get('proxy_port'),
+        )
+    return sci, proxy, get('retries')
 
 
 def dl_by_doi(doi, config=None):
@@ -141,34 +449,129 @@ def dl_by_doi(doi, config=None):
         SciDlError
     """
 
-    def get(key):
-        if key not in config:
-            raise SciDlError(_("malformed configuration, can't find %s") % key)
-        return config[key]
+    # initialize objects, dl is not closed since the returned
+    # response is still streaming
+    sci, proxy, retries = _parse_config(config)
+    return _dl_by_doi(doi, Dl(retries, proxy), sci)
 
-    if config is None:
-        config = DEFAULT_CONFIG.copy()
-
-    # initialize objects
-    sci = Sci(get('base_url'))
-    proxy = None
-    if get('use_proxy'):
-        proxy = Proxy(
-            protocol=get('proxy_protocol'),
-            user=get('proxy_user'),
-            password=get('proxy_password'),
-            host=get('proxy_host'),
-            port=get('proxy_port'),
-        )
-    dl = Dl(get('retries'), proxy)
 
+def _dl_by_doi(doi, dl, sci):
     # get matchmaker url
     matchmaker_url = sci.get_matchmaker_url_for_doi(doi)
     # download matchmaker response
     matchmaker_response = dl.dl(matchmaker_url)
-    # get parse pdf url
-    pdf_url = sci.parse_pdf_url(matchmaker_response.content)
+    # get parse pdf url, stop reading page once it's found
+    chunks = matchmaker_response.iter_content(MATCHMAKER_CHUNK_SIZE)
+    pdf_url = sci.find_pdf_url(chunks)
+    dl.release(matchmaker_response, chunks)
     if not pdf_url:
         raise SciDlError(_('Failed to parse PDF url of DOI %s') % doi)
     # download pdf response
     return dl.dl(pdf_url)
+
+
+async def dl_by_doi_async(doi, dl, sci):
+    """
+    download PDF by DOI using asyncio
+
+    Args:
+        doi: <str> DOI
+        dl: <AsyncDl> entered AsyncDl
+        sci: <Sci> Sci
+    Returns:
+        aiohttp.ClientResponse, the body is not read, release it after use
+    Raises:
+        SciDlError
+    """
+    # download and parse matchmaker page
+    matchmaker_url = sci.get_matchmaker_url_for_doi(doi)
+    async with await dl.dl(matchmaker_url) as matchmaker_response:
+        content = await matchmaker_response.read()
+    pdf_url = sci.parse_pdf_url(content)
+    if not pdf_url:
+        raise SciDlError(_('Failed to parse PDF url of DOI %s') % doi)
+    # download pdf response
+    return await dl.dl(pdf_url)
+
+
+def _check_pdf_response(doi, response):
+    """
+    a captcha or error page may be served instead of the PDF
+    """
+    if response.headers.get('Content-Type') != PDF_CONTENT_TYPE:
+        raise SciDlError(
+            _('Failed to Download PDF url %s of DOI %s') % (response.url, doi)
+        )
+
+
+async def _dl_many(dois, sci, dl, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def dl_one(doi):
+        async with semaphore:
+            async with await dl_by_doi_async(doi, dl, sci) as response:
+                _check_pdf_response(doi, response)
+                return await response.read()
+
+    async with dl:
+        return await asyncio.gather(
+            *[dl_one(doi) for doi in dois], return_exceptions=True
+        )
+
+
+def _dl_many_threaded(dois, sci, dl, concurrency):
+    def dl_one(doi):
+        try:
+            response = _dl_by_doi(doi, dl, sci)
+            try:
+                _check_pdf_response(doi, response)
+                return response.content
+            finally:
+                response.close()
+        except Exception as e:
+            return e
+
+    with dl, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(dl_one, dois))
+
+
+def _can_dl_async(proxy):
+    """
+    sci-dl[async] is installed and aiohttp_socks supports the proxy
+    """
+    try:
+        import aiohttp  # noqa: F401
+        import aiohttp_socks  # noqa: F401
+    except ImportError:
+        return False
+    return not proxy or proxy.protocol in ASYNC_PROXY_PROTOCOLS
+
+
+def dl_many(dois, config=None, concurrency=DEFAULT_CONCURRENCY):
+    """
+    download PDFs of many DOIs concurrently, asyncio is used if
+    sci-dl[async] is installed and supports the proxy, otherwise threads
+
+    Args:
+        dois: <list> DOIs
+        config: <dict> same as dl_by_doi
+        concurrency: <int> max number of DOIs downloading at the same time
+    Returns:
+        <list> PDF content (bytes) of each DOI, in the same order as dois,
+        the exception is returned instead if the DOI failed or the page
+        served is not a PDF
+    Raises:
+        SciDlError
+    """
+    sci, proxy, retries = _parse_config(config)
+    # a repeated DOI is resolved and downloaded only once
+    unique_dois = list(dict.fromkeys(dois))
+    if _can_dl_async(proxy):
+        results = asyncio.run(
+            _dl_many(unique_dois, sci, AsyncDl(retries, proxy), concurrency)
+        )
+    else:
+        dl = Dl(retries, proxy, pool_maxsize=max(POOL_MAXSIZE, concurrency))
+        results = _dl_many_threaded(unique_dois, sci, dl, concurrency)
+    results = dict(zip(unique_dois, results))
+    return [results[doi] for doi in dois]
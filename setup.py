@@ -11,7 +11,7 @@ DESCRIPTION = 'sci-dl: help you download SciHub PDF programmatically'
 URL = 'https://github.com/soultoolman/sci-dl'
 EMAIL = 'soultooman@gmail.com'
 AUTHOR = 'soultoolman'
-REQUIRES_PYTHON = '>=3.6.0'
+REQUIRES_PYTHON = '>=3.7.0'
 VERSION = '0.1.2'
 
 # What packages are required for this module to be executed?
@@ -28,7 +28,13 @@ EXTRAS = {
         'validators',
         'rich',
         'pysocks',
-    ]
+        'aiohttp',
+        'aiohttp_socks',
+    ],
+    'async': [
+        'aiohttp',
+        'aiohttp_socks',
+    ],
 }
 
 
@@ -96,7 +102,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
         'Topic :: Scientific/Engineering :: Bio-Informatics',
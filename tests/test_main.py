@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from sci_dl import main
+
+
+class FakeUpdater(object):
+    def __init__(self):
+        self.advanced = 0
+
+    def advance(self, size):
+        self.advanced += size
+
+    def flush(self):
+        pass
+
+
+def test_write_pdf(tmp_path):
+    file = tmp_path / 'a.pdf'
+    main.write_pdf(str(file), [b'a' * 10, b'b' * 10], 1000, FakeUpdater())
+    assert file.read_bytes() == b'a' * 10 + b'b' * 10
+
+
+def test_write_pdf_failed(tmp_path):
+    def chunks():
+        yield b'a' * 1000
+        raise IOError('connection reset')
+
+    file = tmp_path / 'a.pdf'
+    with pytest.raises(IOError):
+        main.write_pdf(str(file), chunks(), 10 * 1000 * 1000, FakeUpdater())
+    # no zeros reserved for the missing bytes
+    assert file.stat().st_size == 1000
+
+
+def test_read_dois(tmp_path):
+    file = tmp_path / 'dois.txt'
+    file.write_text(' 10.1000/a \n\n10.1000/b\n10.1000/a\n')
+    assert main.read_dois(str(file)) == ['10.1000/a', '10.1000/b']
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    file = str(tmp_path / 'sci-dl.json')
+    main.Config({
+        'base_url': 'https://sci-hub.se',
+        'retries': 1,
+        'use_proxy': False,
+        'log_file': str(tmp_path / 'sci-dl.log'),
+        'outdir': str(tmp_path),
+        'debug_mode': False,
+    }).write(file)
+    monkeypatch.setattr(main, 'CONFIG_FILE', file)
+    # keep log handlers off the root logger
+    monkeypatch.setattr(main, 'setup_logging', lambda config: None)
+    return file
+
+
+def test_dl_doi_file(tmp_path, config_file, monkeypatch):
+    from click.testing import CliRunner
+
+    calls = []
+    monkeypatch.setattr(
+        main, 'dl_bulk',
+        lambda dois, dl, sh, concurrency, outdir, console: calls.append(
+            (dois, concurrency)
+        )
+    )
+    doi_file = tmp_path / 'dois.txt'
+    doi_file.write_text('10.1000/a\n\n10.1000/b\n10.1000/a\n')
+    result = CliRunner().invoke(
+        main.sci_dl,
+        ['dl', '-d', '10.1000/b', '-f', str(doi_file), '-c', '2'],
+    )
+    assert result.exit_code == 0, result.output
+    assert calls == [(['10.1000/b', '10.1000/a'], 2)]
+
+
+class FakeAsyncPdfResponse(object):
+    """
+    aiohttp response, body is read by content.iter_chunked
+    """
+
+    def __init__(self, chunks, content_type='application/pdf', error=None):
+        self.url = 'https://sci-hub.se/x.pdf'
+        self.headers = {'Content-Type': content_type}
+        # larger than the body, the file must be truncated
+        self.content_length = 1000 * 1000
+        self.content = self
+        self.chunks = chunks
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error:
+            raise self.error
+
+
+class FakeAsyncDl(object):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class FakeConsole(object):
+    def log(self, msg):
+        pass
+
+
+def test_dl_bulk(tmp_path, monkeypatch):
+    responses = {
+        '10.1000/a': FakeAsyncPdfResponse([b'a' * 10, b'b' * 10]),
+        '10.1000/captcha': FakeAsyncPdfResponse([b'<html>'], 'text/html'),
+        '10.1000/reset': FakeAsyncPdfResponse(
+            [b'c' * 10], error=IOError('connection reset')
+        ),
+    }
+
+    async def dl_by_doi_async(doi, dl, sh):
+        return responses[doi]
+
+    monkeypatch.setattr(main, 'dl_by_doi_async', dl_by_doi_async)
+    with pytest.raises(main.SciDlError) as e:
+        main.dl_bulk(
+            list(responses), FakeAsyncDl(), None, 2, str(tmp_path), FakeConsole()
+        )
+    assert str(e.value) == main._('%s of %s DOIs failed to download') % (2, 3)
+    assert (tmp_path / '10.1000_a.pdf').read_bytes() == b'a' * 10 + b'b' * 10
+    assert not (tmp_path / '10.1000_captcha.pdf').exists()
+    assert (tmp_path / '10.1000_reset.pdf').read_bytes() == b'c' * 10